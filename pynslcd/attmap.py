@@ -35,11 +35,20 @@ True
 'uidNumber'
 >>> attrs['gecos']
 '"${gecos:-$cn}"'
+>>> attrs.get_rdn_value('uid=test,ou=people,dc=example,dc=com', 'uid')
+'test'
+>>> attrs.get_rdn_value('UID=test,ou=people,dc=example,dc=com', 'uid')
+'test'
+>>> attrs.get_rdn_value('cn=Test User+uid=test,ou=people,dc=example,dc=com', 'uid')
+'test'
+>>> attrs.get_rdn_value('cn=Test User,ou=people,dc=example,dc=com', 'uid') is None
+True
+>>> Attributes(uid='lower(uid)').get_rdn_value('uid=TEST,dc=example,dc=com', 'uid')
+'test'
 """
 
 import re
 
-from ldap.filter import escape_filter_chars
 import ldap.dn
 
 from expr import Expression
@@ -62,10 +71,8 @@ class SimpleMapping(str):
     def attributes(self):
         return [self]
 
-    def mk_filter(self, value):
-        return '(%s=%s)' % (
-                self, escape_filter_chars(str(value))
-            )
+    def filter_attribute(self):
+        return self
 
     def values(self, variables):
         """Expand the expression using the variables specified."""
@@ -108,10 +115,8 @@ class FunctionMapping(str):
     def attributes(self):
         return [self.attribute]
 
-    def mk_filter(self, value):
-        return '(%s=%s)' % (
-                self.attribute, escape_filter_chars(value)
-            )
+    def filter_attribute(self):
+        return self.attribute
 
     def values(self, variables):
         return [self.function(value)
@@ -122,6 +127,7 @@ class Attributes(dict):
     """Dictionary-like class for handling attribute mapping."""
 
     def __init__(self, *args, **kwargs):
+        self._translation = None
         self.update(*args, **kwargs)
 
     def __setitem__(self, attribute, mapping):
@@ -132,7 +138,8 @@ class Attributes(dict):
             mapping = FunctionMapping(mapping)
         else:
             mapping = SimpleMapping(mapping)
-        super(Attributes, self).__setitem__(attribute, mapping)
+        super(Attributes, self).__setitem__(intern(attribute), mapping)
+        self._translation = None
 
     def update(self, *args, **kwargs):
         for arg in args:
@@ -151,24 +158,51 @@ class Attributes(dict):
             attributes.update(mapping.attributes())
         return list(attributes)
 
-    def mk_filter(self, attribute, value):
-        """Construct a search filter for searching for the attribute value
-        combination."""
+    def filter_attribute(self, attribute):
+        """Return the LDAP attribute name that should be used in search
+        filters for the attribute."""
         mapping = self.get(attribute, SimpleMapping(attribute))
-        return mapping.mk_filter(value)
+        return mapping.filter_attribute()
 
     def translate(self, variables):
         """Return a dictionary with every attribute mapped to their value from
         the specified variables."""
+        if self._translation is None:
+            # split simple attribute renames from the other mappings
+            self._translation = (
+                tuple((attribute, intern(str(mapping)))
+                      for attribute, mapping in self.iteritems()
+                      if isinstance(mapping, SimpleMapping)),
+                tuple((attribute, mapping)
+                      for attribute, mapping in self.iteritems()
+                      if not isinstance(mapping, SimpleMapping)))
+        simple, other = self._translation
+        get = variables.get
         results = dict()
-        for attribute, mapping in self.iteritems():
+        for attribute, name in simple:
+            results[attribute] = get(name, [])
+        for attribute, mapping in other:
             results[attribute] = mapping.values(variables)
         return results
 
     def get_rdn_value(self, dn, attribute):
         """Extract the attribute value from from DN if possible. Return None
         otherwise."""
-        return self.translate(dict(
-                (x, [y])
-                for x, y, z in ldap.dn.str2dn(dn)[0]
-            ))[attribute][0]
+        return self.get_rdn_value_from_rdn(ldap.dn.str2dn(dn)[0], attribute)
+
+    def get_rdn_value_from_rdn(self, rdn, attribute):
+        """Extract the attribute value from the first RDN of a DN as parsed
+        by ldap.dn.str2dn(). Return None if the value is not found."""
+        mapping = self[attribute]
+        if isinstance(mapping, ExpressionMapping):
+            values = mapping.values(dict((x, [y]) for x, y, z in rdn))
+        else:
+            name = mapping.filter_attribute()
+            name_l = name.lower()
+            for x, y, z in rdn:
+                if x == name or x.lower() == name_l:
+                    values = mapping.values({name: [y]})
+                    break
+            else:
+                return None
+        return values[0] if values else None
@@ -19,6 +19,7 @@
 # 02110-1301 USA
 
 import logging
+import string
 import sys
 
 import ldap
@@ -29,6 +30,43 @@ import cfg
 import constants
 
 
+# the default validnames regular expression (common is always imported
+# before the configuration file is read)
+_default_validnames = cfg.validnames
+
+# the characters that are allowed in names by the default validnames value,
+# these must be kept in sync with cfg.validnames (see the doctest below)
+_name_first_chars = string.ascii_letters + string.digits + '._@$'
+_name_middle_chars = _name_first_chars + ' \\~-'
+_name_last_chars = _name_first_chars + '~-'
+
+
+def _is_valid_default_name(name):
+    r"""Check the name against the default validnames value using character
+    deletion instead of the regular expression.
+
+    The check is equivalent to the default regular expression (apart from
+    the trailing newline that $ allows):
+
+    >>> print _default_validnames.pattern
+    ^[a-z0-9._@$][a-z0-9._@$ \\~-]{0,98}[a-z0-9._@$~-]$
+    >>> names = ['a', 'ab', 'Ab', 'a' * 100, 'a' * 101, '-ab', 'ab-',
+    ...          'ab ', ' ab', 'a b', 'a\\b', '\\ab', 'ab\\', 'a~', '~a',
+    ...          'a$b', 'a@b.c_d', 'a!b', 'a\tb', 'a\xe9b']
+    >>> [_is_valid_default_name(x) for x in names]  # doctest: +NORMALIZE_WHITESPACE
+    [False, True, True, True, False, False, True,
+     False, False, True, True, False, False, True, False,
+     True, True, False, False, False]
+    >>> [bool(_default_validnames.search(x)) for x in names] == \
+    ...     [_is_valid_default_name(x) for x in names]
+    True
+    """
+    return (2 <= len(name) <= 100 and
+            name[0] in _name_first_chars and
+            name[-1] in _name_last_chars and
+            not name[1:-1].translate(None, _name_middle_chars))
+
+
 def is_valid_name(name):
     """Checks to see if the specified name seems to be a valid user or group
     name.
@@ -42,13 +80,27 @@ def is_valid_name(name):
     The standard defines user names valid if they contain characters from
     the set [A-Za-z0-9._-] where the hyphen should not be used as first
     character. As an extension this test allows some more characters."""
+    if cfg.validnames is _default_validnames and isinstance(name, str):
+        return _is_valid_default_name(name)
     return bool(cfg.validnames.search(name))
 
 
+def valid_names(names):
+    """Return the list of names that are valid according to
+    is_valid_name(). This avoids per-name overhead when checking many
+    names."""
+    if cfg.validnames is not _default_validnames:
+        search = cfg.validnames.search
+        return [name for name in names if search(name)]
+    return [name for name in names
+            if (_is_valid_default_name(name) if isinstance(name, str)
+                else _default_validnames.search(name))]
+
+
 def validate_name(name):
     """Checks to see if the specified name seems to be a valid user or group
     name. See is_valid_name()."""
-    if not cfg.validnames.search(name):
+    if not is_valid_name(name):
         raise ValueError('%r: denied by validnames option' % name)
 
 
@@ -69,8 +121,12 @@ class Request(object):
         self.fp = fp
         self.conn = conn
         self.calleruid = calleruid
-        module = sys.modules[self.__module__]
-        self.search = getattr(module, 'Search', None)
+        # look up the search class in the module that defines the class once
+        cls = self.__class__
+        if '_module_search' not in cls.__dict__:
+            module = sys.modules[cls.__module__]
+            cls._module_search = getattr(module, 'Search', None)
+        self.search = cls._module_search
         #if not hasattr(module, 'cache_obj'):
         #    cache_cls = getattr(module, 'Cache', None)
         #    module.cache_obj = cache_cls() if cache_cls else None
@@ -91,18 +147,21 @@ class Request(object):
     def handle_request(self, parameters):
         """This method handles the request based on the parameters read
         with read_parameters()."""
+        written = False
         try:
             #with cache.con:
             if True:
                 for values in self.get_results(parameters):
+                    written = True
                     self.fp.write_int32(constants.NSLCD_RESULT_BEGIN)
                     self.write(*values)
                     if self.cache:
                         self.cache.store(*values)
         except ldap.SERVER_DOWN:
-            if self.cache:
+            # results are streamed so the server may go down after entries
+            # have been written, only use the cache if nothing was written
+            if self.cache and not written:
                 logging.debug('read from cache')
-                # we assume server went down before writing any entries
                 for values in self.cache.retrieve(parameters):
                     self.fp.write_int32(constants.NSLCD_RESULT_BEGIN)
                     self.write(*values)
@@ -112,6 +171,9 @@ class Request(object):
         self.fp.write_int32(constants.NSLCD_RESULT_END)
 
     def log(self, parameters):
+        # avoid copying and masking the parameters if it will not be logged
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
         parameters = dict(parameters)
         for param in ('password', 'oldpassword', 'newpassword'):
             if parameters.get(param):
@@ -125,9 +125,7 @@ class GroupRequest(common.Request):
 
     def get_members(self, attributes, members, subgroups, seen):
         # add the memberUid values
-        for member in clean(attributes['memberUid']):
-            if common.is_valid_name(member):
-                members.add(member)
+        members.update(common.valid_names(clean(attributes['memberUid'])))
         # translate and add the member values
         if attmap['member']:
             for memberdn in clean(attributes['member']):
@@ -21,7 +21,9 @@
 import logging
 import sys
 
+from ldap.filter import escape_filter_chars
 import ldap
+import ldap.dn
 import ldap.ldapobject
 
 import cfg
@@ -66,19 +68,66 @@ class Connection(ldap.ldapobject.ReconnectLDAPObject):
         logging.info('connected to LDAP server %s', cfg.uri)
         invalidator.invalidate()
 
-    def search_s(self, *args, **kwargs):
-        # wrapper function to keep the global server_error state
+    def _reconnect(self):
+        self.reconnect(self._uri, retry_max=self._retry_max,
+                       retry_delay=self._retry_delay)
+
+    def _search_first(self, base, scope, filter, attributes):
+        # start the search and wait for the first result
+        msgid = self.search_ext(base, scope, filter, attributes)
+        rtype, rdata = self.result(msgid, all=0)
+        return msgid, rtype, rdata
+
+    def search_iter(self, base, scope, filter, attributes):
+        """Perform an asynchronous search and yield the (dn, attributes)
+        result entries as they are received from the LDAP server. This also
+        keeps the global server_error state."""
         global server_error, first_search
+        msgid = None
         try:
-            res = ldap.ldapobject.ReconnectLDAPObject.search_s(self, *args, **kwargs)
+            # only the synchronous methods reconnect by themselves so do the
+            # same as ReconnectLDAPObject._apply_method_s() here: reconnect
+            # and retry once if the search fails before returning anything
+            if '_l' not in self.__dict__:
+                self._reconnect()
+            try:
+                msgid, rtype, rdata = self._search_first(
+                    base, scope, filter, attributes)
+            except ldap.SERVER_DOWN:
+                ldap.ldapobject.SimpleLDAPObject.unbind_s(self)
+                self._reconnect()
+                msgid, rtype, rdata = self._search_first(
+                    base, scope, filter, attributes)
+            if server_error or first_search:
+                self.reconnect_after_fail()
+                server_error = False
+                first_search = False
+            # other searches on this connection may run while results are
+            # yielded and may reconnect, invalidating our message id
+            reconnects = self._reconnects_done
+            while rtype != ldap.RES_SEARCH_RESULT:
+                for entry in rdata:
+                    yield entry
+                if self._reconnects_done != reconnects:
+                    raise ldap.SERVER_DOWN({
+                        'desc': 'connection was reset during search'})
+                rtype, rdata = self.result(msgid, all=0)
+            msgid = None
         except ldap.SERVER_DOWN:
             server_error = True
+            msgid = None
             raise
-        if server_error or first_search:
-            self.reconnect_after_fail()
-            server_error = False
-            first_search = False
-        return res
+        except ldap.LDAPError:
+            # the search has finished with an error
+            msgid = None
+            raise
+        finally:
+            # stop the search if not all results were consumed
+            if msgid is not None:
+                try:
+                    self.abandon(msgid)
+                except ldap.LDAPError:
+                    pass
 
 
 class LDAPSearch(object):
@@ -114,20 +163,78 @@ class LDAPSearch(object):
     case_insensitive = []
     limit_attributes = []
 
+    # cache of search filter templates (see _get_filter_template())
+    _filter_template_cache = {}
+
     def __init__(self, conn, base=None, scope=None, filter=None,
                  attributes=None, parameters=None):
         self.conn = conn
         # load information from module that defines the class
-        module = sys.modules[self.__module__]
+        cls = self.__class__
+        if '_module_loaded' not in cls.__dict__:
+            cls._load_module_settings()
         if base:
             self.bases = [base]
+        elif cls._module_bases is not None:
+            self.bases = cls._module_bases
+        else:
+            self.bases = cfg.bases
+        if scope:
+            self.scope = scope
+        elif cls._module_scope is not None:
+            self.scope = cls._module_scope
         else:
-            self.bases = getattr(module, 'bases', cfg.bases)
-        self.scope = scope or getattr(module, 'scope', cfg.scope)
-        self.filter = filter or getattr(module, 'filter', None)
-        self.attmap = getattr(module, 'attmap', None)
-        self.attributes = attributes or self.attmap.attributes()
+            self.scope = cfg.scope
+        self.filter = filter or cls._module_filter
+        self.attmap = cls._module_attmap
+        self.attributes = attributes or cls._module_attributes
         self.parameters = parameters or {}
+        # the request parameter values that entries should contain
+        self._case_sensitive_values = tuple(
+            (attr, mapping, self.parameters[attr], str(self.parameters[attr]))
+            for attr, mapping in cls._case_sensitive_pairs
+            if self.parameters.get(attr, None))
+        self._case_insensitive_values = tuple(
+            (attr, mapping, self.parameters[attr],
+             str(self.parameters[attr]).lower())
+            for attr, mapping in cls._case_insensitive_pairs
+            if self.parameters.get(attr, None))
+        self._limit_values = tuple(
+            (attr, self.parameters[attr])
+            for attr in cls.limit_attributes
+            if attr in self.parameters)
+
+    @classmethod
+    def _load_module_settings(cls):
+        """Look up the search definitions (bases, scope, filter and attmap)
+        in the module that defines the class and store them in the class so
+        they do not have to be looked up for every search.
+
+        Searches may be set up concurrently from different threads so
+        everything is computed first and _module_loaded is set last. Until
+        then other threads will just compute the same values."""
+        module = sys.modules[cls.__module__]
+        attmap = getattr(module, 'attmap', None)
+        if attmap:
+            attributes = tuple(attmap.attributes())
+        else:
+            attributes = None
+        # pair the checked attributes with their mapping (used for logging)
+        required_pairs = tuple(
+            (attr, attmap[attr]) for attr in cls.required)
+        case_sensitive_pairs = tuple(
+            (attr, attmap[attr]) for attr in cls.case_sensitive)
+        case_insensitive_pairs = tuple(
+            (attr, attmap[attr]) for attr in cls.case_insensitive)
+        cls._module_bases = getattr(module, 'bases', None)
+        cls._module_scope = getattr(module, 'scope', None)
+        cls._module_filter = getattr(module, 'filter', None)
+        cls._module_attmap = attmap
+        cls._module_attributes = attributes
+        cls._required_pairs = required_pairs
+        cls._case_sensitive_pairs = case_sensitive_pairs
+        cls._case_insensitive_pairs = case_insensitive_pairs
+        cls._module_loaded = True
 
     def __iter__(self):
         return self.items()
@@ -135,14 +242,17 @@ class LDAPSearch(object):
     def items(self):
         """Return the results from the search."""
         filter = self.mk_filter()
+        # only check entries if the class or request parameters need it
+        check = (self._required_pairs or self._case_sensitive_values or
+                 self._case_insensitive_values or self._limit_values)
         for base in self.bases:
             logging.debug('LDAPSearch(base=%r, filter=%r)', base, filter)
             try:
-                for entry in self.conn.search_s(base, self.scope, filter, self.attributes):
-                    if entry[0]:
-                        entry = self._transform(entry[0], entry[1])
-                        if entry:
-                            yield entry
+                for dn, attributes in self.conn.search_iter(base, self.scope, filter, self.attributes):
+                    if dn:
+                        attributes = self._transform(dn, attributes)
+                        if not check or self._check(dn, attributes):
+                            yield dn, attributes
             except ldap.NO_SUCH_OBJECT:
                 # FIXME: log message
                 pass
@@ -150,46 +260,74 @@ class LDAPSearch(object):
     def mk_filter(self):
         """Return the active search filter (based on the read parameters)."""
         if self.parameters:
-            return '(&%s%s)' % (
-                self.filter,
-                ''.join(self.attmap.mk_filter(attribute, value)
-                        for attribute, value in self.parameters.items()))
+            return self._mk_parameters_filter()
         return self.filter
 
+    def _mk_parameters_filter(self):
+        """Return the search filter that selects on all the parameters."""
+        template = self._get_filter_template(frozenset(self.parameters))
+        return template % dict(
+            (attribute, escape_filter_chars(str(value)))
+            for attribute, value in self.parameters.items())
+
+    def _get_filter_template(self, names):
+        """Return a format string for the search filter that selects on the
+        specified parameter names. The values should be filled in using
+        %(name)s placeholders."""
+        key = (self.__class__, self.filter, names)
+        template = self._filter_template_cache.get(key)
+        if template is None:
+            parts = ['(&', str(self.filter).replace('%', '%%')]
+            for attribute in names:
+                parts.append('(')
+                parts.append(
+                    self.attmap.filter_attribute(attribute).replace('%', '%%'))
+                parts.append('=%(')
+                parts.append(attribute)
+                parts.append(')s)')
+            parts.append(')')
+            template = ''.join(parts)
+            self._filter_template_cache[key] = template
+        return template
+
     def _transform(self, dn, attributes):
-        """Handle a single search result entry filtering it with the request
-        parameters, search options and attribute mapping."""
+        """Translate the attributes of a single search result entry using
+        the attribute mapping and the search options."""
         # translate the attributes using the attribute mapping
         if self.attmap:
             attributes = self.attmap.translate(attributes)
         # make sure value from DN is first value
-        for attr in self.canonical_first:
-            primary_value = self.attmap.get_rdn_value(dn, attr)
-            if primary_value:
-                values = attributes[attr]
-                if primary_value in values:
-                    values.remove(primary_value)
-                attributes[attr] = [primary_value] + values
+        if self.canonical_first:
+            rdn = ldap.dn.str2dn(dn)[0]
+            for attr in self.canonical_first:
+                primary_value = self.attmap.get_rdn_value_from_rdn(rdn, attr)
+                if primary_value:
+                    values = attributes[attr]
+                    if primary_value in values:
+                        values.remove(primary_value)
+                    attributes[attr] = [primary_value] + values
+        return attributes
+
+    def _check(self, dn, attributes):
+        """Check the translated attributes of a single search result entry
+        against the request parameters and search options. This returns
+        False if the entry should be skipped."""
         # check that these attributes have at least one value
-        for attr in self.required:
+        for attr, mapping in self._required_pairs:
             if not attributes.get(attr, None):
-                logging.warning('%s: %s: missing', dn, self.attmap[attr])
-                return
+                logging.warning('%s: %s: missing', dn, mapping)
+                return False
         # check that requested attribute is present (case sensitive)
-        for attr in self.case_sensitive:
-            value = self.parameters.get(attr, None)
-            if value and str(value) not in attributes[attr]:
-                logging.debug('%s: %s: does not contain %r value', dn, self.attmap[attr], value)
-                return  # not found, skip entry
+        for attr, mapping, value, svalue in self._case_sensitive_values:
+            if svalue not in attributes[attr]:
+                logging.debug('%s: %s: does not contain %r value', dn, mapping, value)
+                return False  # not found, skip entry
         # check that requested attribute is present (case insensitive)
-        for attr in self.case_insensitive:
-            value = self.parameters.get(attr, None)
-            if value and str(value).lower() not in (x.lower() for x in attributes[attr]):
-                logging.debug('%s: %s: does not contain %r value', dn, self.attmap[attr], value)
-                return  # not found, skip entry
+        for attr, mapping, value, lvalue in self._case_insensitive_values:
+            if lvalue not in (x.lower() for x in attributes[attr]):
+                logging.debug('%s: %s: does not contain %r value', dn, mapping, value)
+                return False  # not found, skip entry
         # limit attribute values to requested value
-        for attr in self.limit_attributes:
-            if attr in self.parameters:
-                attributes[attr] = [self.parameters[attr]]
-        # return the entry
-        return dn, attributes
+        for attr, value in self._limit_values:
+            attributes[attr] = [value]
+        return True
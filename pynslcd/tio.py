@@ -66,17 +66,19 @@ class TIOStream(object):
         self.fp.write(value)
 
     def write_int32(self, value):
-        self.write(_int32.pack(value))
+        self.fp.write(_int32.pack(value))
 
     def write_string(self, value):
-        self.write_int32(len(value))
-        self.write(value)
+        self.fp.write(_int32.pack(len(value)) + value)
 
     def write_stringlist(self, value):
         lst = tuple(value)
-        self.write_int32(len(lst))
+        # build the complete list in memory and write it at once
+        parts = [_int32.pack(len(lst))]
         for string in lst:
-            self.write_string(string)
+            parts.append(_int32.pack(len(string)))
+            parts.append(string)
+        self.fp.write(''.join(parts))
 
     @staticmethod
     def _to_address(value):